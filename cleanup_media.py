@@ -2,10 +2,89 @@
 Cleanup script for Manim media files
 Run this periodically to clean up any orphaned media files
 """
-import shutil
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import time
 
+# Prefix of the per-request scripts and media directories main.py creates
+RENDER_TMP_PREFIX = "manim_"
+
+def fast_rmtree(path):
+    """
+    Delete a directory tree with a single flat scandir walk
+    
+    Unlike shutil.rmtree this does no recursion: every file is collected and
+    unlinked in one loop, then the directories are removed bottom-up.
+    
+    Args:
+        path: Directory to delete (str or Path)
+    """
+    stack = [os.fspath(path)]
+    files = []
+    dirs = []
+    while stack:
+        current = stack.pop()
+        dirs.append(current)
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    files.append(entry.path)
+    for file_path in files:
+        os.unlink(file_path)
+    for dir_path in reversed(dirs):
+        os.rmdir(dir_path)
+
+def rmtree_if_exists(path):
+    """Delete a directory tree, ignoring it if it does not exist (no preflight stat)"""
+    try:
+        fast_rmtree(path)
+    except FileNotFoundError:
+        pass
+
+def render_tmp_roots():
+    """Directories renders may write scratch files to (RENDER_TMP_DIR, tmpfs or the system temp dir)"""
+    roots = (os.getenv("RENDER_TMP_DIR"), "/dev/shm", tempfile.gettempdir())
+    return list(dict.fromkeys(root for root in roots if root and os.path.isdir(root)))
+
+def sweep_render_leftovers(root, current_time, max_age_seconds):
+    """
+    Delete render scripts and media directories under root older than max_age_seconds
+    
+    Renders clean up after themselves; this catches what a crashed worker left behind.
+    
+    Returns:
+        Number of entries deleted
+    """
+    deleted_count = 0
+    # DirEntry carries the file type from the directory read, so only the
+    # mtime check needs a stat call per candidate
+    try:
+        entries = os.scandir(root)
+    except FileNotFoundError:
+        return 0
+    with entries:
+        for entry in entries:
+            if not entry.name.startswith(RENDER_TMP_PREFIX):
+                continue
+            # A live render may delete its own script or media dir at any point here
+            try:
+                entry_age = current_time - entry.stat(follow_symlinks=False).st_mtime
+                if entry_age <= max_age_seconds:
+                    continue
+                print(f"Deleting old render leftover: {entry.path}")
+                if entry.is_dir(follow_symlinks=False):
+                    rmtree_if_exists(entry.path)
+                else:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            deleted_count += 1
+    return deleted_count
+
 def cleanup_old_media(max_age_hours=24):
     """
     Delete media files older than max_age_hours
@@ -14,50 +93,19 @@ def cleanup_old_media(max_age_hours=24):
         max_age_hours: Maximum age in hours before deletion (default: 24 hours)
     """
     media_dir = Path("media")
-    
-    if not media_dir.exists():
-        print("No media directory found")
-        return
-    
     current_time = time.time()
     max_age_seconds = max_age_hours * 3600
     deleted_count = 0
     
-    # Cleanup videos
-    videos_dir = media_dir / "videos"
-    if videos_dir.exists():
-        for temp_dir in videos_dir.iterdir():
-            if temp_dir.is_dir() and temp_dir.name.startswith("tmp"):
-                dir_age = current_time - temp_dir.stat().st_mtime
-                if dir_age > max_age_seconds:
-                    print(f"Deleting old video directory: {temp_dir}")
-                    shutil.rmtree(temp_dir)
-                    deleted_count += 1
-    
-    # Cleanup images
-    images_dir = media_dir / "images"
-    if images_dir.exists():
-        for temp_dir in images_dir.iterdir():
-            if temp_dir.is_dir() and temp_dir.name.startswith("tmp"):
-                dir_age = current_time - temp_dir.stat().st_mtime
-                if dir_age > max_age_seconds:
-                    print(f"Deleting old image directory: {temp_dir}")
-                    shutil.rmtree(temp_dir)
-                    deleted_count += 1
-    
-    # Cleanup nested media/media structure
-    nested_media = media_dir / "media"
-    if nested_media.exists():
-        for subdir in ["videos", "images"]:
-            subdir_path = nested_media / subdir
-            if subdir_path.exists():
-                for temp_dir in subdir_path.iterdir():
-                    if temp_dir.is_dir() and temp_dir.name.startswith("tmp"):
-                        dir_age = current_time - temp_dir.stat().st_mtime
-                        if dir_age > max_age_seconds:
-                            print(f"Deleting old directory: {temp_dir}")
-                            shutil.rmtree(temp_dir)
-                            deleted_count += 1
+    # Cleanup scripts and media directories orphaned in the render scratch space
+    temp_roots = render_tmp_roots()
+    # The roots are independent and deletion is syscall-bound, so sweep them in parallel
+    with ThreadPoolExecutor(max_workers=max(1, len(temp_roots))) as executor:
+        futures = [
+            executor.submit(sweep_render_leftovers, root, current_time, max_age_seconds)
+            for root in temp_roots
+        ]
+        deleted_count += sum(future.result() for future in futures)
     
     # Cleanup Tex files
     tex_dir = media_dir / "Tex"
@@ -77,7 +125,7 @@ def cleanup_all_media():
     
     if media_dir.exists():
         print("WARNING: Deleting ALL media files...")
-        shutil.rmtree(media_dir)
+        fast_rmtree(media_dir)
         print("All media files deleted")
     else:
         print("No media directory found")
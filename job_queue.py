@@ -1,56 +1,301 @@
 #!/usr/bin/env python3
 """
-Persistent job queue using file-based storage.
+Persistent job queue backed by a single append-only log (queue.wal).
 This prevents job loss during container restarts.
+
+Every change is appended as one orjson line (put / upd / del) and mirrored
+in an in-memory index, so recovery is one sequential read of the log.
+Jobs left as <job_id>.json files by the older one-file-per-job layout are
+imported into the log the first time it is compacted.
+
+Writes are group-committed: once start_flusher() has been called, records
+are buffered and a background thread writes them with a single writev +
+fdatasync every FLUSH_INTERVAL seconds (or as soon as FLUSH_BATCH records
+are waiting). The tradeoff is a crash window: a job acknowledged less than
+FLUSH_INTERVAL before a hard crash can be missing from the log. Without the
+flusher every change is written and synced before the call returns.
+
+Several processes may share the queue directory (e.g. old and new workers
+during a rolling restart). Appends and compactions hold an exclusive flock
+on queue.lock, compaction rebuilds the log from what is on disk rather than
+from one process's index, and a writer reopens the log when another process
+has replaced it.
 """
-import json
+import atexit
 import os
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+
+import orjson
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; the thread locks still apply
+    fcntl = None
 
 # Cross-platform queue directory (works on Windows and Linux)
 QUEUE_DIR = Path(os.getenv("JOB_QUEUE_DIR", "job_queue"))
 QUEUE_DIR.mkdir(exist_ok=True)
+WAL_FILE = QUEUE_DIR / "queue.wal"
+LOCK_FILE = QUEUE_DIR / "queue.lock"
+
+# Rewrite the log once it holds this many times more records than live jobs
+COMPACT_RATIO = 2
+COMPACT_MIN_RECORDS = 64
+
+# Group commit tuning
+FLUSH_INTERVAL = 0.01  # seconds
+FLUSH_BATCH = 16
+IOV_MAX = 1024
+
+# macOS has writev but no fdatasync
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+_JOBS: Dict[str, Dict[str, Any]] = {}
+_pending: List[bytes] = []
+_wal_records = 0
+_wal = None
+
+# _lock guards the index and the pending buffer; _write_lock serializes
+# writers of the log file within this process, and the flock on LOCK_FILE
+# across processes. Always take _write_lock before _lock.
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+_flush_event = threading.Event()
+_flusher: Optional[threading.Thread] = None
+_lock_fd = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+
+
+@contextmanager
+def _log_lock():
+    """Hold the cross-process lock on the log (caller holds _write_lock)"""
+    if fcntl:
+        fcntl.flock(_lock_fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        if fcntl:
+            fcntl.flock(_lock_fd, fcntl.LOCK_UN)
+
+
+def _apply(jobs: Dict[str, Dict[str, Any]], record: Dict[str, Any]) -> None:
+    """Apply a single log record to an index"""
+    op = record["op"]
+    job_id = record["job_id"]
+    if op == "put":
+        jobs[job_id] = record["job"]
+    elif op == "upd":
+        job = jobs.get(job_id)
+        if job is not None:
+            job.update(record["fields"])
+    elif op == "del":
+        jobs.pop(job_id, None)
+
+
+def _read_log() -> Dict[str, Dict[str, Any]]:
+    """Rebuild an index from the log on disk"""
+    jobs: Dict[str, Dict[str, Any]] = {}
+    if not WAL_FILE.exists():
+        return jobs
+    for line in WAL_FILE.read_bytes().splitlines():
+        try:
+            _apply(jobs, orjson.loads(line))
+        except Exception as e:
+            # A torn final line from a crash mid-append is expected; skip it
+            print(f"Skipping unreadable job log record: {e}")
+    return jobs
+
+
+def _import_legacy(jobs: Dict[str, Dict[str, Any]]) -> List[Path]:
+    """Add jobs from the old one-file-per-job layout to an index; returns the files read"""
+    imported = []
+    for job_file in QUEUE_DIR.glob("*.json"):
+        try:
+            job = orjson.loads(job_file.read_bytes())
+            jobs.setdefault(job["job_id"], job)
+            imported.append(job_file)
+        except Exception as e:
+            print(f"Error reading job file {job_file}: {e}")
+    return imported
+
+
+def _write_all(fd: int, batch: List[bytes]) -> None:
+    """Write every line of the batch, resuming after short writes"""
+    if not hasattr(os, "writev"):
+        data = b"".join(batch)
+        while data:
+            data = data[os.write(fd, data):]
+        return
+    for start in range(0, len(batch), IOV_MAX):
+        buffers = batch[start:start + IOV_MAX]
+        while buffers:
+            written = os.writev(fd, buffers)
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            if written:
+                buffers[0] = buffers[0][written:]
+
+
+def _open_log() -> None:
+    global _wal
+    if _wal is not None:
+        _wal.close()
+    _wal = open(WAL_FILE, 'ab', buffering=0)
+
+
+def _reopen_if_replaced() -> None:
+    """Reopen the log if another process compacted it away (caller holds the log lock)"""
+    try:
+        replaced = os.fstat(_wal.fileno()).st_ino != os.stat(WAL_FILE).st_ino
+    except FileNotFoundError:
+        replaced = True
+    if replaced:
+        _open_log()
+
+
+def _append(batch: List[bytes]) -> None:
+    """Append a batch with one writev + fdatasync (caller holds _write_lock)"""
+    with _log_lock():
+        _reopen_if_replaced()
+        fd = _wal.fileno()
+        _write_all(fd, batch)
+        _datasync(fd)
+
+
+def _compact() -> None:
+    """Rewrite the log as one put per live job and refresh the index from it (caller holds _write_lock)"""
+    global _wal_records
+    with _log_lock():
+        # Rebuild from disk so records appended by other processes survive
+        jobs = _read_log()
+        legacy_files = _import_legacy(jobs)
+        snapshot = [
+            orjson.dumps({"op": "put", "job_id": job_id, "job": job}) + b"\n"
+            for job_id, job in jobs.items()
+        ]
+        tmp_file = WAL_FILE.with_suffix(".wal.tmp")
+        with open(tmp_file, 'wb') as f:
+            f.write(b"".join(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, WAL_FILE)
+        _open_log()
+        # The imported jobs are in the log now
+        for job_file in legacy_files:
+            job_file.unlink(missing_ok=True)
+
+    with _lock:
+        # Records buffered since the batch was taken are not on disk yet
+        for line in _pending:
+            _apply(jobs, orjson.loads(line))
+        _JOBS.clear()
+        _JOBS.update(jobs)
+        _wal_records = len(snapshot) + len(_pending)
+
+
+def _record(record: Dict[str, Any]) -> None:
+    """Apply a record and buffer it for the log (caller holds _lock)"""
+    global _wal_records
+    _apply(_JOBS, record)
+    _pending.append(orjson.dumps(record) + b"\n")
+    _wal_records += 1
+
+
+def flush() -> None:
+    """Write all buffered records to the log now"""
+    global _pending
+    with _write_lock:
+        with _lock:
+            batch = _pending
+            _pending = []
+            compact = _wal_records > max(COMPACT_MIN_RECORDS, COMPACT_RATIO * len(_JOBS))
+        if batch:
+            try:
+                _append(batch)
+            except Exception:
+                # Put the records back so the next flush retries them instead of dropping them
+                with _lock:
+                    _pending = batch + _pending
+                raise
+        if compact:
+            try:
+                _compact()
+            except Exception as e:
+                # The appended log is still complete; compaction is retried on a later flush
+                print(f"Error compacting job log: {e}")
+
+
+def _commit() -> None:
+    """Hand buffered records to the flusher, or write them inline when it is not running"""
+    if _flusher is None:
+        flush()
+    elif len(_pending) >= FLUSH_BATCH:
+        _flush_event.set()
+
+
+def _flush_loop() -> None:
+    while True:
+        _flush_event.wait(FLUSH_INTERVAL)
+        _flush_event.clear()
+        try:
+            flush()
+        except Exception as e:
+            print(f"Error flushing job log: {e}")
+
+
+def start_flusher() -> None:
+    """Start the background group-commit thread (safe to call more than once)"""
+    global _flusher
+    with _lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_flush_loop, name="job-queue-flusher", daemon=True)
+        _flusher.start()
+
+
+# Start from a compacted log; this also drops a torn record left by a crash
+# and imports any jobs from the old layout
+with _write_lock:
+    _compact()
+atexit.register(flush)
+
 
 def save_job(job_id: str, payload: Dict[str, Any]) -> None:
     """Save a job to persistent storage"""
-    job_file = QUEUE_DIR / f"{job_id}.json"
-    with open(job_file, 'w') as f:
-        json.dump({
+    with _lock:
+        _record({
+            "op": "put",
             "job_id": job_id,
-            "status": "queued",
-            "payload": payload
-        }, f)
+            "job": {
+                "job_id": job_id,
+                "status": "queued",
+                "payload": payload
+            }
+        })
+    _commit()
 
 def update_job_status(job_id: str, status: str, **kwargs) -> None:
     """Update job status"""
-    job_file = QUEUE_DIR / f"{job_id}.json"
-    if not job_file.exists():
-        return
-    
-    with open(job_file, 'r+') as f:
-        data = json.load(f)
-        data['status'] = status
-        data.update(kwargs)
-        f.seek(0)
-        json.dump(data, f)
-        f.truncate()
+    with _lock:
+        if job_id not in _JOBS:
+            return
+        _record({"op": "upd", "job_id": job_id, "fields": {"status": status, **kwargs}})
+    _commit()
 
 def delete_job(job_id: str) -> None:
     """Delete a completed job"""
-    job_file = QUEUE_DIR / f"{job_id}.json"
-    if job_file.exists():
-        job_file.unlink()
+    with _lock:
+        if job_id not in _JOBS:
+            return
+        _record({"op": "del", "job_id": job_id})
+    _commit()
 
 def get_pending_jobs() -> list:
     """Get all pending jobs (for recovery after restart)"""
-    jobs = []
-    for job_file in QUEUE_DIR.glob("*.json"):
-        try:
-            with open(job_file, 'r') as f:
-                data = json.load(f)
-                if data.get('status') in ['queued', 'processing']:
-                    jobs.append(data)
-        except Exception as e:
-            print(f"Error reading job file {job_file}: {e}")
-    return jobs
+    with _lock:
+        return [
+            dict(job) for job in _JOBS.values()
+            if job.get('status') in ['queued', 'processing']
+        ]
@@ -1,26 +1,43 @@
 import asyncio
+import base64
+import hashlib
+import logging
+import queue
+import re
+import shutil
 import threading
 import time
+from contextlib import asynccontextmanager
 from uuid import uuid4
 
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from supabase import create_client, Client
+from storage3 import SyncStorageClient
+from storage3.utils import SyncClient
 import os
 import subprocess
 import tempfile
-import shutil
 from pathlib import Path
 from typing import Optional
 from dotenv import load_dotenv
-import requests
-from moviepy import VideoFileClip, AudioFileClip
+import httpx
 import job_queue
+from cleanup_media import RENDER_TMP_PREFIX, rmtree_if_exists
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI(title="Manim API with Supabase")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Batch job queue writes into one fdatasync per tick while the API is serving
+    job_queue.start_flusher()
+    yield
+
+
+app = FastAPI(title="Manim API with Supabase", lifespan=lifespan)
+
 
 # Health check endpoint
 @app.get("/")
@@ -45,6 +62,58 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")  # Changed from SUPABASE_ANON_KEY to match .env file
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Keep storage connections warm between uploads (httpx drops idle ones after 5s)
+STORAGE_POOL_LIMITS = httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300)
+
+
+class PooledStorageClient(SyncStorageClient):
+    """Supabase storage client whose HTTP/2 session keeps idle connections open."""
+
+    def _create_session(self, base_url, headers, timeout, verify=True, proxy=None) -> SyncClient:
+        return SyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            proxy=proxy,
+            verify=bool(verify),
+            follow_redirects=True,
+            http2=True,
+            limits=STORAGE_POOL_LIMITS,
+        )
+
+
+# One storage client (and connection pool) shared by every request
+storage = PooledStorageClient(
+    supabase.storage_url, supabase.options.headers, supabase.options.storage_client_timeout
+)
+
+# Shared client for media downloads and job callbacks, so repeat requests to the same
+# host reuse a kept-alive (HTTP/2) connection instead of a fresh TLS handshake each time.
+# httpx.Client is thread-safe, which matters because jobs run in worker threads.
+http_client = httpx.Client(
+    http2=True,
+    follow_redirects=True,
+    timeout=30,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300),
+)
+
+# Public object URLs are a fixed prefix plus bucket and path, so they are built locally
+PUBLIC_URL_BASE = f"{str(supabase.storage_url).rstrip('/')}/object/public"
+
+# Bucket that rendered (pre-mux) videos are uploaded to
+RENDER_BUCKET = "videos"
+
+# storage3 streams BufferedReader uploads through httpx's multipart encoder;
+# a 1 MiB read buffer keeps RSS flat without a syscall per 64 KiB chunk
+UPLOAD_BUFFER_SIZE = 1 << 20
+
+# Files larger than one chunk go through Supabase's resumable (TUS) endpoint, so a
+# dropped connection costs one chunk instead of the whole upload. Supabase requires
+# 6 MiB chunks and accepts them strictly in order.
+TUS_CHUNK_SIZE = 6 * 1024 * 1024
+TUS_CHUNK_RETRIES = 3
+TUS_HEADERS = {"Tus-Resumable": "1.0.0"}
+
 class RenderRequest(BaseModel):
     script_code: str  # Complete Manim script with scene class definition
     scene_name: str  # Name of the scene class to render
@@ -71,19 +140,57 @@ class AsyncRenderRequest(RenderRequest):
     bucket_name: str = "muxvideos"
     audio_speed: float = 1.0
 
-# Map quality to Manim flags
-QUALITY_FLAGS = {
-    "low": "-ql",
-    "medium": "-qm",
-    "high": "-qh",
-    "4k": "-qk",
+# Map quality to the Manim flag and the folder Manim writes videos into
+QUALITY_SETTINGS = {
+    "low": ("-ql", "480p15"),
+    "medium": ("-qm", "720p30"),
+    "high": ("-qh", "1080p60"),
+    "4k": ("-qk", "2160p60"),
 }
 
+# Full Manim output is only logged when MANIM_DEBUG is set; otherwise the debug
+# calls return before formatting anything
+log = logging.getLogger("render")
+if os.getenv("MANIM_DEBUG"):
+    log.setLevel(logging.DEBUG)
+    log.addHandler(logging.StreamHandler())
+
+# Manim renderer: "cairo" (CPU, default) or "opengl" (GPU, needs a GL-capable host)
+MANIM_RENDERER = os.getenv("MANIM_RENDERER", "cairo")
+# Manim stderr that means the GPU renderer itself could not start (no GL/EGL context or
+# display), as opposed to an error in the script; only these fall back to cairo. Matching is
+# case-sensitive and on whole words, since Manim's tracebacks also echo the script's source
+GL_ERROR_PATTERN = re.compile(
+    rb"\bmoderngl\.error\.Error\b|\bglcontext\b|\blibGL error\b|\b[Cc]annot open display\b"
+    rb"|\b(?:EGL|GLX)\b[^\n]{0,80}\b(?:error|failed)\b"
+)
+
+# Upper bound on Manim processes running at once across all requests
+MAX_RENDER_PROCESSES = int(os.getenv("MAX_RENDER_PROCESSES", os.cpu_count() or 1))
+RENDER_SLOTS = threading.BoundedSemaphore(MAX_RENDER_PROCESSES)
+# Renders queue here for a slot; one dispatcher thread hands slots out in arrival order
+RENDER_SLOT_REQUESTS: "queue.Queue[tuple[asyncio.AbstractEventLoop, asyncio.Future]]" = queue.Queue()
+
+# Scratch space for per-request Manim output (unset: the system temp dir). Pointing it at
+# tmpfs such as /dev/shm keeps renders off the disk, but tmpfs pages count against the
+# container's memory and Docker's default /dev/shm is only 64MB, so it is opt-in
+RENDER_TMP_DIR = os.getenv("RENDER_TMP_DIR") or None
+# A render falls back to the system temp dir when RENDER_TMP_DIR has less free space than this
+RENDER_TMP_MIN_FREE = int(os.getenv("RENDER_TMP_MIN_FREE_MB", "1024")) * 1024 * 1024
+# Render scripts are only a few KB, so they always go to tmpfs when the host has one
+SCRIPT_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# One pass over a script finds both the scene classes to render and substrings that
+# reject it outright. The scene branch is a lookahead, so class names are still
+# scanned for unsafe substrings.
+SCRIPT_PATTERN = re.compile(
+    r'(?P<unsafe>import\s+os|subprocess|exec\b|__import__|open\(|file\()'
+    r'|(?=class\s+(?P<scene>\w+)\s*\(\s*Scene\s*\))'
+)
+
 
 def fix_manim_script(script_code: str) -> str:
     """Fix common Manim script errors generated by AI."""
-    import re
-    
     # Fix Triangle with vertices - replace with Polygon
     # Pattern: Triangle([x1, y1, z1], [x2, y2, z2], [x3, y3, z3], ...)
     triangle_pattern = r'Triangle\(\s*\[([^\]]+)\]\s*,\s*\[([^\]]+)\]\s*,\s*\[([^\]]+)\]([^)]*)\)'
@@ -157,7 +264,7 @@ def deliver_callback(url: str, payload: dict, secret: str | None) -> None:
         headers["X-Callback-Secret"] = secret
 
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=20)
+        response = http_client.post(url, json=payload, headers=headers, timeout=20)
         response.raise_for_status()
         print(f"[CALLBACK] Delivered job {payload.get('jobId')} update with status {payload.get('status')}")
     except Exception as error:
@@ -179,6 +286,8 @@ def process_render_and_mux_job(job_id: str, payload: dict) -> None:
         "muxRecordId": async_request.mux_record_id,
         "status": "PROCESSING",
     }
+    # Collects the render's media cleanup, run as soon as the render is uploaded
+    cleanup_tasks = BackgroundTasks()
 
     try:
         render_request = RenderRequest(
@@ -187,7 +296,10 @@ def process_render_and_mux_job(job_id: str, payload: dict) -> None:
             quality=async_request.quality,
         )
 
-        render_result = asyncio.run(render_and_upload(render_request))
+        render_result = asyncio.run(render_and_upload(render_request, cleanup_tasks))
+        # The mux re-downloads the render from its public URL, so free the render's
+        # media (possibly tmpfs memory) before it starts
+        asyncio.run(cleanup_tasks())
         video_url = render_result.get("video_url")
         callback_payload["videoUrl"] = video_url
         callback_payload["message"] = render_result.get("message")
@@ -253,7 +365,9 @@ async def render_and_upload_async(request: AsyncRenderRequest):
     # Save job to persistent storage
     job_queue.save_job(job_id, payload)
 
-    # Use non-daemon thread to prevent job loss on container restart
+    # Use non-daemon thread to prevent job loss on container restart. Blocking calls in
+    # the job go through run_in_threadpool rather than asyncio.to_thread, whose executor
+    # refuses new work once the interpreter starts shutting down.
     worker = threading.Thread(
         target=process_render_and_mux_job,
         args=(job_id, payload),
@@ -266,121 +380,369 @@ async def render_and_upload_async(request: AsyncRenderRequest):
     return {"status": "queued", "job_id": job_id}
 
 
-@app.post("/render-and-upload")
-async def render_and_upload(request: RenderRequest):
-    # Basic security check (expand in prod, e.g., sandbox with restricted globals)
-    unsafe_keywords = ["import os", "subprocess", "exec", "__import__", "open(", "file("]
-    if any(keyword in request.script_code for keyword in unsafe_keywords):
-        raise HTTPException(status_code=400, detail="Unsafe code detected")
+async def run_subprocess(
+    args: list[str], timeout: float | None = None, input: bytes | None = None, text: bool = True
+) -> subprocess.CompletedProcess:
+    """Run a command without blocking the event loop, killing it on timeout or cancellation.
+
+    With text=False stdout and stderr are returned as raw bytes.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE if input is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(input), timeout)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if text:
+        stdout = stdout.decode("utf-8", errors="replace")
+        stderr = stderr.decode("utf-8", errors="replace")
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+def grant_render_slot(waiter: asyncio.Future) -> None:
+    """Hand a taken slot to its waiter, or give it back if the waiter was cancelled."""
+    if waiter.cancelled():
+        RENDER_SLOTS.release()
+    else:
+        waiter.set_result(None)
+
+
+def dispatch_render_slots() -> None:
+    """Take a slot for each queued waiter in turn and wake it on its own event loop."""
+    while True:
+        loop, waiter = RENDER_SLOT_REQUESTS.get()
+        if waiter.cancelled():
+            continue
+        RENDER_SLOTS.acquire()
+        try:
+            loop.call_soon_threadsafe(grant_render_slot, waiter)
+        except RuntimeError:
+            # The waiter's event loop has already closed
+            RENDER_SLOTS.release()
+
+
+# A plain daemon thread rather than an executor, so renders still get slots while the
+# interpreter is shutting down and non-daemon job threads are finishing
+threading.Thread(target=dispatch_render_slots, name="render-slot-dispatcher", daemon=True).start()
+
+
+async def acquire_render_slot() -> None:
+    """Wait for a free Manim process slot, first come first served, without blocking the event loop."""
+    # Async jobs run on their own event loops in worker threads, so the limit is a
+    # threading semaphore rather than an asyncio.Semaphore. The dispatcher thread
+    # blocks on it for the oldest waiter and resolves that waiter's future.
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    RENDER_SLOT_REQUESTS.put((loop, waiter))
+    try:
+        await waiter
+    except asyncio.CancelledError:
+        # Cancelling the wait cancels the future, and grant_render_slot returns the slot;
+        # if the slot was granted just before the cancellation, give it back here
+        if waiter.done() and not waiter.cancelled():
+            RENDER_SLOTS.release()
+        raise
+
+
+def manim_command(renderer: str, media_dir: Path, flag: str, temp_path: str, scene_names: list[str]) -> list[str]:
+    """Build the Manim CLI invocation for a batch of scenes."""
+    command = [
+        "manim",
+        "--media_dir", str(media_dir),
+        # Partial movies live in the per-request media dir and are never reused,
+        # so skip hashing every animation for the cache
+        "--disable_caching",
+        flag,
+        "--renderer", renderer,
+    ]
+    if renderer == "opengl":
+        # The OpenGL renderer only writes a video file when asked to
+        command.append("--write_to_movie")
+    return [*command, temp_path, *scene_names]
+
+
+async def render_scenes(
+    temp_path: str, media_dir: Path, flag: str, quality_folder: str, scene_names: list[str]
+) -> list[Path]:
+    """Render several scenes in one Manim process and return the generated videos in order."""
+    temp_file_base = Path(temp_path).stem
+    label = ", ".join(f"'{scene_name}'" for scene_name in scene_names)
+    timeout = 300 * len(scene_names)  # 5 minutes per scene for longer animations
+    print(f"Rendering scenes: {label}")
+
+    await acquire_render_slot()
+    try:
+        # Manim's output stays as bytes; only the slice reported on failure is decoded
+        result = await run_subprocess(
+            manim_command(MANIM_RENDERER, media_dir, flag, temp_path, scene_names), timeout=timeout, text=False
+        )
+        if result.returncode != 0 and MANIM_RENDERER != "cairo" and GL_ERROR_PATTERN.search(result.stderr):
+            print(f"{MANIM_RENDERER} renderer could not get a GL context for {label}; retrying with cairo")
+            result = await run_subprocess(
+                manim_command("cairo", media_dir, flag, temp_path, scene_names), timeout=timeout, text=False
+            )
+    except TimeoutError:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Scenes {label} timed out after {timeout} seconds. A scene likely contains an infinite loop, excessive computations, or animations that take too long. Simplify the scene animations and reduce complexity."
+        )
+    finally:
+        RENDER_SLOTS.release()
+
+    # Log the Manim output for debugging
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Manim stdout for %s:\n%s", label, result.stdout.decode("utf-8", errors="replace"))
+        log.debug("Manim stderr for %s:\n%s", label, result.stderr.decode("utf-8", errors="replace"))
+        log.debug("Manim return code for %s: %s", label, result.returncode)
+
+    if result.returncode != 0:
+        error_excerpt = result.stderr[:500].decode("utf-8", errors="replace")
+        # Check if it's a LaTeX error ("LaTeX" is covered by the lowercase check)
+        if b"tex" in result.stderr.lower():
+            raise HTTPException(
+                status_code=500, 
+                detail=f"LaTeX rendering failed in scenes {label}. Use Text() instead of Tex() for simple text. Error: {error_excerpt}"
+            )
+        raise HTTPException(status_code=500, detail=f"Render failed for scenes {label}: {error_excerpt}")
+
+    # --media_dir makes the output location deterministic
+    video_dir = media_dir / "videos" / temp_file_base / quality_folder
+    output_files = []
+    for scene_name in scene_names:
+        output_file = video_dir / f"{scene_name}.mp4"
+        if not output_file.exists():
+            raise HTTPException(
+                status_code=500, 
+                detail=f"Output file not generated for scene '{scene_name}'. Checked: {output_file}"
+            )
+        
+        output_files.append(output_file)
+        print(f"Successfully rendered: {output_file}")
+    return output_files
+
+
+def split_scene_batches(scene_names: list[str], workers: int) -> list[list[str]]:
+    """Split scenes into at most `workers` contiguous, evenly sized batches."""
+    workers = max(1, min(workers, len(scene_names)))
+    size, extra = divmod(len(scene_names), workers)
+    batches = []
+    start = 0
+    for index in range(workers):
+        end = start + size + (1 if index < extra else 0)
+        batches.append(scene_names[start:end])
+        start = end
+    return batches
+
+
+def public_url_for(bucket_name: str, file_path: str) -> str:
+    """Build the public URL of an object in a public Supabase storage bucket."""
+    return f"{PUBLIC_URL_BASE}/{bucket_name}/{file_path}"
+
+
+def render_exists(file_path: str) -> bool:
+    """Check whether a rendered video with exactly this name is already in the render bucket."""
+    try:
+        matches = storage.from_(RENDER_BUCKET).list("", {"search": file_path})
+    except Exception as error:
+        # A failed lookup only costs a re-render
+        print(f"Warning: Could not check for an existing render: {error}")
+        return False
+    return any(item.get("name") == file_path for item in matches)
+
+
+def tus_header(response: httpx.Response, name: str) -> str:
+    """Read a header the TUS protocol requires, failing clearly if a proxy stripped it."""
+    value = response.headers.get(name)
+    if value is None:
+        raise HTTPException(status_code=500, detail=f"Resumable upload response is missing the {name} header")
+    return value
+
+
+def is_retryable(error: httpx.HTTPError) -> bool:
+    """Transport errors, 429 and 5xx are worth retrying; other statuses will fail the same way again."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def upload_resumable(bucket_name: str, object_path: str, file_path: Path, content_type: str) -> str:
+    """Upload a file over TUS in TUS_CHUNK_SIZE chunks, resuming from the server's offset after a failed chunk."""
+    size = file_path.stat().st_size
+    metadata = {"bucketName": bucket_name, "objectName": object_path, "contentType": content_type}
+    response = storage.session.post(
+        "/upload/resumable",
+        headers={
+            **TUS_HEADERS,
+            "Upload-Length": str(size),
+            "Upload-Metadata": ",".join(
+                f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in metadata.items()
+            ),
+            "x-upsert": "true",
+        },
+    )
+    response.raise_for_status()
+    upload_url = tus_header(response, "Location")
+
+    offset = 0
+    failures = 0
+    resync = False
+    with open(file_path, "rb") as f:
+        while True:
+            try:
+                if resync:
+                    # Continue from whatever the server actually stored
+                    response = storage.session.head(upload_url, headers=TUS_HEADERS)
+                    response.raise_for_status()
+                    offset = int(tus_header(response, "Upload-Offset"))
+                    resync = False
+                if offset >= size:
+                    break
+                f.seek(offset)
+                response = storage.session.patch(
+                    upload_url,
+                    content=f.read(TUS_CHUNK_SIZE),
+                    headers={
+                        **TUS_HEADERS,
+                        "Upload-Offset": str(offset),
+                        "Content-Type": "application/offset+octet-stream",
+                    },
+                )
+                response.raise_for_status()
+                offset = int(tus_header(response, "Upload-Offset"))
+                failures = 0
+            except httpx.HTTPError as error:
+                failures += 1
+                if not is_retryable(error) or failures > TUS_CHUNK_RETRIES:
+                    raise
+                print(f"Warning: Upload at offset {offset} failed ({error}); resuming")
+                time.sleep(failures)
+                resync = True
+    return upload_url
+
+
+def upload_video(bucket_name: str, object_path: str, file_path: Path):
+    """Upload an MP4 to storage, resumably when it spans more than one chunk; returns the upload result."""
+    if file_path.stat().st_size > TUS_CHUNK_SIZE:
+        return upload_resumable(bucket_name, object_path, file_path, "video/mp4")
+    with open(file_path, "rb", buffering=UPLOAD_BUFFER_SIZE) as video_file:
+        upload_result = storage.from_(bucket_name).upload(
+            object_path, video_file, {"content-type": "video/mp4", "upsert": "true"}
+        )
+    return getattr(upload_result, "data", upload_result)
+
+
+def render_tmp_dir() -> str | None:
+    """Pick the media directory root for one render: RENDER_TMP_DIR unless it is short on space."""
+    if RENDER_TMP_DIR is None:
+        return None
+    try:
+        if shutil.disk_usage(RENDER_TMP_DIR).free >= RENDER_TMP_MIN_FREE:
+            return RENDER_TMP_DIR
+    except OSError as error:
+        print(f"Warning: Could not check free space in {RENDER_TMP_DIR}: {error}")
+    print(f"Warning: {RENDER_TMP_DIR} is low on space; rendering in the system temp dir")
+    return None
 
-    # Fix common Manim script errors
+
+def cleanup_render_outputs(media_dir: Path) -> None:
+    """Delete a request's Manim media directory (videos, partial movies, images, text caches)."""
+    try:
+        rmtree_if_exists(media_dir)
+    except Exception as cleanup_error:
+        # Log cleanup errors but don't fail the request
+        print(f"Warning: Failed to cleanup media files: {cleanup_error}")
+
+
+@app.post("/render-and-upload")
+async def render_and_upload(request: RenderRequest, background_tasks: BackgroundTasks = None):
+    # Fix common Manim script errors. This runs first because the fixers can rewrite
+    # class headers too (e.g. "class DrawAngle(Scene)"), so scene names must come from
+    # the code that is actually rendered.
     fixed_script_code = fix_manim_script(request.script_code)
 
-    # Extract all scene class names from the script
-    import re
-    scene_pattern = r'class\s+(\w+)\s*\(\s*Scene\s*\)'
-    scene_matches = re.findall(scene_pattern, fixed_script_code)
+    # Basic security check (expand in prod, e.g., sandbox with restricted globals) on the
+    # code that will run, extracting all scene class names from it in the same pass
+    scene_matches = []
+    for match in SCRIPT_PATTERN.finditer(fixed_script_code):
+        if match.group("unsafe"):
+            raise HTTPException(status_code=400, detail="Unsafe code detected")
+        scene_matches.append(match.group("scene"))
     
     if not scene_matches:
         raise HTTPException(status_code=400, detail="No Scene classes found in script")
     
     print(f"Found {len(scene_matches)} scenes: {scene_matches}")
 
+    # Renders are content-addressed: identical script + quality map to the same object,
+    # so a repeat request returns the existing video without rendering again
+    content_hash = hashlib.blake2b(fixed_script_code.encode("utf-8"), digest_size=16).hexdigest()
+    file_path = f"manim_{content_hash}_{request.quality}.mp4"
+    if await run_in_threadpool(render_exists, file_path):
+        print(f"Reusing existing render: {file_path}")
+        return {
+            "success": True,
+            "video_url": public_url_for(RENDER_BUCKET, file_path),
+            "message": f"Reused existing render of {len(scene_matches)} scenes: {file_path}",
+            "scenes_rendered": len(scene_matches)
+        }
+
     # Write complete Manim script to temp file with UTF-8 encoding for Unicode symbols
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False, encoding="utf-8") as temp_file:
+    with tempfile.NamedTemporaryFile(
+        mode="w", prefix=RENDER_TMP_PREFIX, suffix=".py", delete=False, encoding="utf-8", dir=SCRIPT_TMP_DIR
+    ) as temp_file:
         temp_file.write(fixed_script_code)
         temp_path = temp_file.name
 
-    rendered_videos = []
-    temp_file_base = Path(temp_path).stem
+    # Per-request media directory so concurrent renders never share Manim output paths
+    media_dir = Path(tempfile.mkdtemp(prefix=RENDER_TMP_PREFIX, dir=render_tmp_dir()))
+    cleanup_scheduled = False
     
     try:
-        # Render each scene individually
-        flag = QUALITY_FLAGS.get(request.quality, "-ql")
-        quality_folder = {
-            "low": "480p15",
-            "medium": "720p30", 
-            "high": "1080p60",
-            "4k": "2160p60"
-        }.get(request.quality, "480p15")
+        flag, quality_folder = QUALITY_SETTINGS.get(request.quality, QUALITY_SETTINGS["low"])
         
-        for scene_name in scene_matches:
-            print(f"Rendering scene: {scene_name}")
-            
-            try:
-                result = subprocess.run(
-                    ["manim", flag, temp_path, scene_name],
-                    capture_output=True,
-                    text=True,
-                    timeout=300  # 5 minute timeout per scene for longer animations
-                )
-            except subprocess.TimeoutExpired:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Scene '{scene_name}' timed out after 300 seconds. The scene likely contains an infinite loop, excessive computations, or animations that take too long. Simplify the scene animations and reduce complexity."
-                )
-
-            # Log the Manim output for debugging
-            print(f"=== Manim STDOUT for {scene_name} ===")
-            print(result.stdout)
-            print(f"=== Manim STDERR for {scene_name} ===")
-            print(result.stderr)
-            print(f"=== Return Code for {scene_name} ===")
-            print(result.returncode)
-
-            if result.returncode != 0:
-                # Check if it's a LaTeX error
-                error_msg = result.stderr
-                if "LaTeX" in error_msg or "tex" in error_msg.lower():
-                    raise HTTPException(
-                        status_code=500, 
-                        detail=f"LaTeX rendering failed in scene '{scene_name}'. Use Text() instead of Tex() for simple text. Error: {result.stderr[:500]}"
-                    )
-                raise HTTPException(status_code=500, detail=f"Render failed for scene '{scene_name}': {result.stderr[:500]}")
-
-            # Find the rendered video file
-            media_dir = Path("media")
-            possible_paths = [
-                media_dir / "videos" / temp_file_base / quality_folder / f"{scene_name}.mp4",
-                media_dir / "media" / "videos" / temp_file_base / quality_folder / f"{scene_name}.mp4",
-            ]
-            
-            output_file = None
-            for path in possible_paths:
-                if path.exists():
-                    output_file = path
-                    break
-            
-            if not output_file or not output_file.exists():
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"Output file not generated for scene '{scene_name}'. Checked: {[str(p) for p in possible_paths]}"
-                )
-            
-            rendered_videos.append(output_file)
-            print(f"Successfully rendered: {output_file}")
+        # Each Manim process pays interpreter + import startup once for a whole batch
+        # of scenes. There are never more batches than render slots, since extra batches
+        # would only queue for a slot and pay that startup again. Stop the rest if one fails.
+        # Every batch gets its own media dir: Manim's texts/ SVG cache is check-then-write,
+        # so two processes sharing it could read each other's half-written files
+        render_tasks = [
+            asyncio.create_task(render_scenes(temp_path, media_dir / f"batch{index}", flag, quality_folder, batch))
+            for index, batch in enumerate(split_scene_batches(scene_matches, MAX_RENDER_PROCESSES))
+        ]
+        try:
+            batch_videos = await asyncio.gather(*render_tasks)
+        except BaseException:
+            for task in render_tasks:
+                task.cancel()
+            await asyncio.gather(*render_tasks, return_exceptions=True)
+            raise
+        rendered_videos = [video for videos in batch_videos for video in videos]
 
         # Concatenate all videos into one using ffmpeg
         if len(rendered_videos) == 1:
             # Only one video, no need to concatenate
             final_video = rendered_videos[0]
         else:
-            # Create a temporary file list for ffmpeg concat
-            concat_list_path = Path("media") / f"{temp_file_base}_concat.txt"
-            with open(concat_list_path, "w") as f:
-                for video in rendered_videos:
-                    f.write(f"file '{video.absolute()}'\n")
+            # ffmpeg reads the concat list from stdin, so no list file is written
+            concat_input = "".join(f"file '{video.absolute()}'\n" for video in rendered_videos).encode()
             
             # Output path for concatenated video
-            final_video = Path("media") / "videos" / temp_file_base / quality_folder / "final_output.mp4"
-            final_video.parent.mkdir(parents=True, exist_ok=True)
+            final_video = media_dir / "final_output.mp4"
             
-            # Concatenate videos using ffmpeg
-            concat_result = subprocess.run(
-                ["ffmpeg", "-f", "concat", "-safe", "0", "-i", str(concat_list_path), 
-                 "-c", "copy", str(final_video)],
-                capture_output=True,
-                text=True
+            # Concatenate videos using ffmpeg; +faststart puts the index up front so the
+            # public URL can start playing before the whole file is downloaded
+            concat_result = await run_subprocess(
+                ["ffmpeg", "-f", "concat", "-safe", "0", "-protocol_whitelist", "pipe,file",
+                 "-i", "pipe:0", "-c", "copy", "-movflags", "+faststart", str(final_video)],
+                input=concat_input,
             )
             
             if concat_result.returncode != 0:
@@ -390,71 +752,22 @@ async def render_and_upload(request: RenderRequest):
                     detail=f"Failed to concatenate videos: {concat_result.stderr[:500]}"
                 )
             
-            # Clean up concat list file
-            concat_list_path.unlink()
             print(f"Successfully concatenated {len(rendered_videos)} videos into: {final_video}")
 
         # Upload the final video to Supabase Storage
-        bucket_name = "videos"
-        timestamp = int(Path(temp_path).stem.replace("tmp", "")[-8:], 36) if "tmp" in temp_path else ""
-        file_path = f"manim_{timestamp}_{request.quality}.mp4"
-        
-        with open(final_video, "rb") as video_file:
-            upload_result = supabase.storage.from_(bucket_name).upload(
-                file_path, video_file, {"upsert": "true"}
-            )
+        upload_data = await run_in_threadpool(upload_video, RENDER_BUCKET, file_path, final_video)
 
         # Basic success check
-        upload_data = getattr(upload_result, "data", upload_result)
         if not upload_data:
             raise HTTPException(status_code=500, detail="Upload failed")
 
         # Get public URL
-        public_res = supabase.storage.from_(bucket_name).get_public_url(file_path)
-        public_data = getattr(public_res, "data", public_res)
-        if isinstance(public_data, dict):
-            public_url = public_data.get("publicUrl") or public_data.get("public_url") or public_data.get("signedUrl")
-        else:
-            public_url = str(public_data)
-        if not public_url:
-            raise HTTPException(status_code=500, detail="Could not obtain public URL from Supabase")
+        public_url = public_url_for(RENDER_BUCKET, file_path)
 
-        # Clean up: Delete all rendered videos and directories
-        try:
-            # Delete individual scene videos
-            for video in rendered_videos:
-                if video.exists():
-                    video.unlink()
-            
-            # Delete final video if it's different from individual videos
-            if final_video not in rendered_videos and final_video.exists():
-                final_video.unlink()
-            
-            # Delete the entire temp directory created by Manim
-            media_dir = Path("media")
-            
-            # Clean up videos directory
-            video_dir = media_dir / "videos" / temp_file_base
-            if video_dir.exists():
-                shutil.rmtree(video_dir)
-            
-            # Clean up images directory (if any)
-            images_dir = media_dir / "images" / temp_file_base
-            if images_dir.exists():
-                shutil.rmtree(images_dir)
-                
-            # Also check nested media/media structure
-            nested_video_dir = media_dir / "media" / "videos" / temp_file_base
-            if nested_video_dir.exists():
-                shutil.rmtree(nested_video_dir)
-                
-            nested_images_dir = media_dir / "media" / "images" / temp_file_base
-            if nested_images_dir.exists():
-                shutil.rmtree(nested_images_dir)
-                
-        except Exception as cleanup_error:
-            # Log cleanup errors but don't fail the request
-            print(f"Warning: Failed to cleanup media files: {cleanup_error}")
+        # Clean up Manim's output after the response is sent
+        if background_tasks is not None:
+            background_tasks.add_task(cleanup_render_outputs, media_dir)
+            cleanup_scheduled = True
 
         return {
             "success": True,
@@ -466,54 +779,70 @@ async def render_and_upload(request: RenderRequest):
     finally:
         # Clean up temp script
         os.unlink(temp_path)
+        # Failed renders (and direct callers without background tasks) clean up right away
+        if not cleanup_scheduled:
+            cleanup_render_outputs(media_dir)
+
+def download_to_file(url: str, path: Path, label: str) -> None:
+    """Stream a remote file to disk in 1 MiB chunks instead of buffering it in memory."""
+    with http_client.stream("GET", url) as response:
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail=f"Failed to download {label}: {response.status_code}")
+        with open(path, "wb") as f:
+            for chunk in response.iter_bytes(chunk_size=1 << 20):
+                f.write(chunk)
+
+
+async def probe_duration(path: Path) -> float:
+    """Read a media file's duration in seconds from its container header with ffprobe."""
+    result = await run_subprocess([
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(path),
+    ])
+    if result.returncode != 0:
+        raise ValueError(result.stderr.strip() or f"ffprobe exited with code {result.returncode}")
+    return float(result.stdout)
+
 
 @app.post("/mux-audio-video")
 async def mux_audio_video(request: MuxRequest):
-    video_clip = None
-    audio_clip = None
-    final_clip = None
-    
     # Download files to temp
     with tempfile.TemporaryDirectory() as temp_dir:
         try:
             temp_path = Path(temp_dir)
             
-            # Download video
             video_path = temp_path / "input_video.mp4"
-            video_resp = requests.get(request.video_url, timeout=30)
-            if video_resp.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to download video: {video_resp.status_code}")
-            with open(video_path, "wb") as f:
-                f.write(video_resp.content)
             
-            # Download audio - detect extension from URL
+            # Detect audio extension from URL
             audio_extension = request.audio_url.split('.')[-1].split('?')[0]  # Extract extension, remove query params
             if audio_extension not in ['mp3', 'wav', 'm4a', 'aac']:
                 audio_extension = 'mp3'  # Default fallback
             audio_path = temp_path / f"input_audio.{audio_extension}"
-            audio_resp = requests.get(request.audio_url, timeout=30)
-            if audio_resp.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to download audio: {audio_resp.status_code}")
-            with open(audio_path, "wb") as f:
-                f.write(audio_resp.content)
             
-            # Load with MoviePy
+            # Download video and audio concurrently, off the event loop
+            await asyncio.gather(
+                run_in_threadpool(download_to_file, request.video_url, video_path, "video"),
+                run_in_threadpool(download_to_file, request.audio_url, audio_path, "audio"),
+            )
+            
+            # Read durations from the container headers; this also rejects files ffmpeg can't read
             try:
-                video_clip = VideoFileClip(str(video_path))
-                audio_clip = AudioFileClip(str(audio_path))
+                video_duration, audio_duration = await asyncio.gather(
+                    probe_duration(video_path), probe_duration(audio_path)
+                )
             except Exception as load_error:
                 raise HTTPException(
                     status_code=400, 
                     detail=f"Failed to load media files: {str(load_error)}. Audio file: {audio_path.name}"
                 )
             
-            # Speed up audio if requested (using ffmpeg via subprocess for better quality)
+            # Speed up audio in the same ffmpeg pass as the mux
+            # atempo can only go from 0.5 to 2.0, so we may need to chain filters
+            audio_args = ["-c:a", "aac", "-b:a", "192k"]
             if request.audio_speed != 1.0:
                 print(f"Speeding up audio by {request.audio_speed}x")
-                sped_audio_path = temp_path / f"sped_audio.{audio_extension}"
-                
-                # Use ffmpeg atempo filter for audio speed adjustment
-                # atempo can only go from 0.5 to 2.0, so we may need to chain filters
                 speed = request.audio_speed
                 atempo_filters = []
                 
@@ -525,86 +854,40 @@ async def mux_audio_video(request: MuxRequest):
                     speed /= 0.5
                 
                 atempo_filters.append(f"atempo={speed}")
-                filter_str = ",".join(atempo_filters)
-                
-                ffmpeg_cmd = [
-                    "ffmpeg", "-i", str(audio_path),
-                    "-filter:a", filter_str,
-                    "-y",  # Overwrite output
-                    str(sped_audio_path)
-                ]
-                
-                result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
-                if result.returncode != 0:
-                    print(f"Warning: Failed to speed up audio: {result.stderr}")
-                    # Continue with original audio if speed adjustment fails
-                else:
-                    # Close original audio and load the sped-up version
-                    audio_clip.close()
-                    audio_clip = AudioFileClip(str(sped_audio_path))
-            
-            # Get durations
-            video_duration = video_clip.duration
-            audio_duration = audio_clip.duration
-            
-            # Mux: Handle different audio/video length scenarios
-            if audio_duration > video_duration:
-                # Audio is longer - trim audio to video length
-                audio_clip = audio_clip.subclipped(0, video_duration)
-            elif audio_duration < video_duration:
-                # Audio is shorter - you might want to loop audio or just use what's available
-                # For now, we'll just use the available audio (video will be silent after audio ends)
-                pass
-            
-            final_clip = video_clip.with_audio(audio_clip)
+                audio_args = ["-filter:a", ",".join(atempo_filters)] + audio_args
+                audio_duration /= request.audio_speed
+            elif audio_extension in ('m4a', 'aac'):
+                # AAC can go into the MP4 container as-is
+                audio_args = ["-c:a", "copy"]
             
-            # Export to temp output
+            # Mux: copy the video stream untouched and only touch the audio. The output
+            # keeps the video's length, so longer audio is trimmed to it and shorter audio
+            # leaves the rest of the video silent.
             output_path = temp_path / f"{request.output_name}.mp4"
-            final_clip.write_videofile(
-                str(output_path), 
-                codec="libx264", 
-                audio_codec="aac",
-                audio_bitrate="192k",  # Explicitly set audio bitrate
-                temp_audiofile=str(temp_path / "temp-audio.m4a"),
-                remove_temp=True,
-                logger=None  # Suppress moviepy progress bars in logs
-            )
-            
-            # Close clips to free resources BEFORE uploading
-            try:
-                if final_clip:
-                    final_clip.close()
-                if audio_clip:
-                    audio_clip.close()
-                if video_clip:
-                    video_clip.close()
-            except Exception as close_error:
-                print(f"Warning: Error closing clips: {close_error}")
+            mux_result = await run_subprocess([
+                "ffmpeg", "-y",
+                "-i", str(video_path),
+                "-i", str(audio_path),
+                "-map", "0:v:0", "-map", "1:a:0",
+                "-c:v", "copy",
+                *audio_args,
+                "-t", str(video_duration),
+                "-movflags", "+faststart",
+                str(output_path),
+            ])
+            if mux_result.returncode != 0:
+                raise HTTPException(status_code=500, detail=f"Muxing failed: {mux_result.stderr[-500:]}")
             
             # Upload to Supabase
             file_name = f"{request.output_name}.mp4"
-            with open(output_path, "rb") as output_file:
-                upload_result = supabase.storage.from_(request.bucket_name).upload(
-                    file_name, 
-                    output_file,
-                    {"contentType": "video/mp4", "upsert": "true"}
-                )
+            upload_data = await run_in_threadpool(upload_video, request.bucket_name, file_name, output_path)
             
             # Check upload success
-            upload_data = getattr(upload_result, "data", upload_result)
             if not upload_data:
                 raise HTTPException(status_code=500, detail="Upload to Supabase failed")
             
             # Get public URL (using same pattern as render-and-upload endpoint)
-            public_res = supabase.storage.from_(request.bucket_name).get_public_url(file_name)
-            public_data = getattr(public_res, "data", public_res)
-            if isinstance(public_data, dict):
-                public_url = public_data.get("publicUrl") or public_data.get("public_url") or public_data.get("signedUrl")
-            else:
-                public_url = str(public_data)
-            
-            if not public_url:
-                raise HTTPException(status_code=500, detail="Could not obtain public URL from Supabase")
+            public_url = public_url_for(request.bucket_name, file_name)
             
             return {
                 "success": True,
@@ -618,17 +901,6 @@ async def mux_audio_video(request: MuxRequest):
             raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Muxing failed: {str(e)}")
-        finally:
-            # Ensure all clips are closed even if an error occurs
-            try:
-                if final_clip:
-                    final_clip.close()
-                if audio_clip:
-                    audio_clip.close()
-                if video_clip:
-                    video_clip.close()
-            except Exception as cleanup_error:
-                print(f"Warning: Failed to close video clips: {cleanup_error}")
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
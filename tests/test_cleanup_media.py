@@ -0,0 +1,82 @@
+import os
+import time
+
+import cleanup_media
+
+
+def test_sweeps_old_render_leftovers(tmp_path, monkeypatch):
+    monkeypatch.setenv("RENDER_TMP_DIR", str(tmp_path))
+    old = time.time() - 2 * 3600
+
+    old_dir = tmp_path / "manim_old"
+    (old_dir / "batch0" / "videos").mkdir(parents=True)
+    (old_dir / "batch0" / "videos" / "A.mp4").write_bytes(b"x")
+    old_script = tmp_path / "manim_old.py"
+    old_script.write_text("pass")
+    fresh_dir = tmp_path / "manim_fresh"
+    fresh_dir.mkdir()
+    unrelated = tmp_path / "tmp_other"
+    unrelated.mkdir()
+    for path in (old_dir, old_script, unrelated):
+        os.utime(path, (old, old))
+
+    deleted = cleanup_media.sweep_render_leftovers(tmp_path, time.time(), 3600)
+
+    assert deleted == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["manim_fresh", "tmp_other"]
+
+
+def test_render_tmp_roots_include_env_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("RENDER_TMP_DIR", str(tmp_path))
+    assert cleanup_media.render_tmp_roots()[0] == str(tmp_path)
+
+
+class Entries(list):
+    """scandir result stand-in: a list of entries that is also a context manager"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class VanishingEntry:
+    """DirEntry whose file a finishing render deletes before or right after it is stat'ed"""
+
+    def __init__(self, entry, before_stat):
+        self.entry = entry
+        self.before_stat = before_stat
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        if self.before_stat:
+            os.unlink(self.path)
+        result = os.stat(self.path, follow_symlinks=follow_symlinks)
+        os.unlink(self.path)
+        return result
+
+
+def test_sweep_skips_entries_deleted_mid_sweep(tmp_path, monkeypatch):
+    old = time.time() - 2 * 3600
+    for name in ("manim_a.py", "manim_b.py", "manim_c.py"):
+        (tmp_path / name).write_text("pass")
+        os.utime(tmp_path / name, (old, old))
+    real_scandir = os.scandir
+
+    def scandir(path):
+        with real_scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        vanishing = {"manim_a.py": True, "manim_b.py": False}
+        return Entries(
+            VanishingEntry(entry, vanishing[entry.name]) if entry.name in vanishing else entry for entry in entries
+        )
+
+    monkeypatch.setattr(cleanup_media.os, "scandir", scandir)
+
+    assert cleanup_media.sweep_render_leftovers(tmp_path, time.time(), 3600) == 1
+    assert list(tmp_path.iterdir()) == []
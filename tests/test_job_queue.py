@@ -0,0 +1,142 @@
+import importlib
+import json
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def load_queue(tmp_path, monkeypatch):
+    """Import a fresh job_queue over tmp_path; each call acts like a new process."""
+    monkeypatch.setenv("JOB_QUEUE_DIR", str(tmp_path))
+    original = sys.modules.get("job_queue")
+
+    def load():
+        sys.modules.pop("job_queue", None)
+        return importlib.import_module("job_queue")
+
+    yield load
+    if original is not None:
+        sys.modules["job_queue"] = original
+    else:
+        sys.modules.pop("job_queue", None)
+
+
+def log_lines(queue):
+    return queue.WAL_FILE.read_bytes().splitlines()
+
+
+def test_jobs_survive_restart(load_queue):
+    queue = load_queue()
+    queue.save_job("a", {"n": 1})
+    queue.save_job("b", {"n": 2})
+    queue.update_job_status("a", "processing", attempt=1)
+    queue.delete_job("b")
+
+    restarted = load_queue()
+    assert restarted.get_pending_jobs() == [
+        {"job_id": "a", "status": "processing", "payload": {"n": 1}, "attempt": 1}
+    ]
+
+
+def test_replay_skips_torn_last_record(load_queue):
+    queue = load_queue()
+    queue.save_job("a", {"n": 1})
+    with open(queue.WAL_FILE, "ab") as f:
+        f.write(b'{"op":"put","job_id":"b","jo')
+
+    restarted = load_queue()
+    assert [job["job_id"] for job in restarted.get_pending_jobs()] == ["a"]
+    # Startup compaction drops the torn bytes, so the next append is readable
+    restarted.save_job("c", {"n": 3})
+    assert sorted(job["job_id"] for job in load_queue().get_pending_jobs()) == ["a", "c"]
+
+
+def test_compaction_rewrites_log_to_live_jobs(load_queue, monkeypatch):
+    queue = load_queue()
+    monkeypatch.setattr(queue, "COMPACT_MIN_RECORDS", 4)
+    queue.save_job("a", {"n": 1})
+    for attempt in range(10):
+        queue.update_job_status("a", "processing", attempt=attempt)
+    queue.save_job("b", {"n": 2})
+    queue.delete_job("b")
+
+    assert len(log_lines(queue)) <= 4
+    assert load_queue().get_pending_jobs() == [
+        {"job_id": "a", "status": "processing", "payload": {"n": 1}, "attempt": 9}
+    ]
+
+
+def test_flush_writes_buffered_records(load_queue, monkeypatch):
+    queue = load_queue()
+    # Pretend the flusher thread is running so records are only buffered
+    monkeypatch.setattr(queue, "_flusher", object())
+    queue.save_job("a", {"n": 1})
+    assert log_lines(queue) == []
+
+    queue.flush()
+    assert len(log_lines(queue)) == 1
+    assert queue._pending == []
+
+
+def test_failed_write_is_retried(load_queue, monkeypatch):
+    queue = load_queue()
+    monkeypatch.setattr(queue, "_flusher", object())
+    queue.save_job("a", {"n": 1})
+
+    def fail(fd, buffers):
+        raise OSError(28, "No space left on device")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(queue.os, "writev", fail)
+        with pytest.raises(OSError):
+            queue.flush()
+    assert len(queue._pending) == 1
+
+    queue.flush()
+    assert [job["job_id"] for job in load_queue().get_pending_jobs()] == ["a"]
+
+
+def test_short_writes_are_completed(load_queue, monkeypatch):
+    queue = load_queue()
+    real_writev = queue.os.writev
+    with monkeypatch.context() as patch:
+        patch.setattr(queue.os, "writev", lambda fd, buffers: real_writev(fd, [buffers[0][:5]]))
+        queue.save_job("a", {"n": 1})
+        queue.save_job("b", {"n": 2})
+
+    assert sorted(job["job_id"] for job in load_queue().get_pending_jobs()) == ["a", "b"]
+
+
+def test_imports_jobs_from_old_layout(load_queue, tmp_path):
+    (tmp_path / "old.json").write_text(json.dumps({"job_id": "old", "status": "queued", "payload": {}}))
+    (tmp_path / "done.json").write_text(json.dumps({"job_id": "done", "status": "completed", "payload": {}}))
+
+    queue = load_queue()
+    assert [job["job_id"] for job in queue.get_pending_jobs()] == ["old"]
+    assert list(tmp_path.glob("*.json")) == []
+    assert [job["job_id"] for job in load_queue().get_pending_jobs()] == ["old"]
+
+
+def test_writer_follows_log_replaced_by_another_process(load_queue):
+    first = load_queue()
+    first.save_job("a", {"n": 1})
+    # A second process starting up compacts (replaces) the log
+    second = load_queue()
+    assert [job["job_id"] for job in second.get_pending_jobs()] == ["a"]
+
+    first.save_job("b", {"n": 2})
+    second.save_job("c", {"n": 3})
+    assert sorted(job["job_id"] for job in load_queue().get_pending_jobs()) == ["a", "b", "c"]
+
+
+def test_compaction_keeps_other_processes_records(load_queue, monkeypatch):
+    first = load_queue()
+    second = load_queue()
+    first.save_job("a", {"n": 1})
+
+    monkeypatch.setattr(second, "COMPACT_MIN_RECORDS", 0)
+    monkeypatch.setattr(second, "COMPACT_RATIO", 0)
+    second.save_job("b", {"n": 2})
+
+    assert sorted(job["job_id"] for job in load_queue().get_pending_jobs()) == ["a", "b"]
@@ -0,0 +1,27 @@
+import main
+
+
+def test_render_media_is_freed_before_mux(monkeypatch):
+    events = []
+
+    async def render_and_upload(request, background_tasks):
+        background_tasks.add_task(events.append, "cleanup")
+        return {"video_url": "https://example.com/render.mp4", "message": "rendered"}
+
+    async def mux_audio_video(request):
+        events.append("mux")
+        return {"combined_url": "https://example.com/final.mp4", "message": "muxed"}
+
+    monkeypatch.setattr(main, "render_and_upload", render_and_upload)
+    monkeypatch.setattr(main, "mux_audio_video", mux_audio_video)
+    monkeypatch.setattr(main, "deliver_callback", lambda url, payload, secret: events.append(payload["status"]))
+
+    payload = main.AsyncRenderRequest(
+        script_code="class A(Scene): pass", scene_name="A", prompt_id="p", prompt_record_id="pr",
+        script_id="s", video_record_id="v", mux_record_id="m", audio_url="https://example.com/a.mp3",
+        callback_url="https://example.com/callback",
+    ).model_dump()
+    main.job_queue.save_job("job", payload)
+    main.process_render_and_mux_job("job", payload)
+
+    assert events == ["cleanup", "mux", "COMPLETED"]
@@ -0,0 +1,41 @@
+import asyncio
+
+import main
+
+
+def test_render_slots_are_granted_in_arrival_order(monkeypatch):
+    monkeypatch.setattr(main, "RENDER_SLOTS", main.threading.BoundedSemaphore(1))
+    order = []
+
+    async def render(name):
+        await main.acquire_render_slot()
+        order.append(name)
+        await asyncio.sleep(0.01)
+        main.RENDER_SLOTS.release()
+
+    async def run():
+        tasks = []
+        for name in range(5):
+            tasks.append(asyncio.create_task(render(name)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_cancelled_waiter_gives_its_slot_back(monkeypatch):
+    monkeypatch.setattr(main, "RENDER_SLOTS", main.threading.BoundedSemaphore(1))
+
+    async def run():
+        await main.acquire_render_slot()
+        waiter = asyncio.create_task(main.acquire_render_slot())
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        main.RENDER_SLOTS.release()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.wait_for(main.acquire_render_slot(), 1)
+        main.RENDER_SLOTS.release()
+
+    asyncio.run(run())
+    assert main.RENDER_SLOTS.acquire(blocking=False)
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def render(script_code):
+    return asyncio.run(main.render_and_upload(main.RenderRequest(script_code=script_code, scene_name="A")))
+
+
+@pytest.mark.parametrize("script_code", [
+    "import os\nclass A(Scene): pass",
+    "class A(Scene):\n    subprocess.run(['ls'])",
+    "class subprocess(Scene): pass",
+])
+def test_rejects_unsafe_code(script_code):
+    with pytest.raises(HTTPException, match="Unsafe code detected"):
+        render(script_code)
+
+
+@pytest.mark.parametrize("script_code", [
+    "x = 1",
+    # fix_manim_script rewrites these headers, so there is nothing left to render
+    "class DrawAngle(Scene): pass",
+    "class IdentityMatrix(Scene): pass",
+])
+def test_rejects_scripts_without_renderable_scenes(script_code):
+    with pytest.raises(HTTPException, match="No Scene classes found"):
+        render(script_code)
+
+
+def test_scene_names_come_from_fixed_script():
+    fixed = main.fix_manim_script("class A(Scene): pass\nclass DrawAngle(Scene): pass\n")
+    scenes = [match.group("scene") for match in main.SCRIPT_PATTERN.finditer(fixed)]
+    assert scenes == ["A"]
+
+
+@pytest.mark.parametrize("stderr", [
+    b"moderngl.error.Error: Failed to create an OpenGL context",
+    b"Exception: (standalone) XOpenDisplay: cannot open display\n  File \"/usr/lib/python3/glcontext/x11.py\"",
+    b"libGL error: MESA-LOADER: failed to open swrast",
+    b"EGL: eglInitialize failed",
+])
+def test_gl_startup_errors_fall_back_to_cairo(stderr):
+    assert main.GL_ERROR_PATTERN.search(stderr)
+
+
+@pytest.mark.parametrize("stderr", [
+    # Manim's rich traceback echoes the failing source line
+    b"\xe2\x94\x82 \xe2\x9d\xb1 12 \xe2\x94\x82         self.play(Create(display_box))\n"
+    b"NameError: name 'display_box' is not defined",
+    b"ValueError: the difference is negligible, error out",
+    b"RuntimeError: context manager failed to open display_window",
+])
+def test_script_errors_do_not_fall_back_to_cairo(stderr):
+    assert not main.GL_ERROR_PATTERN.search(stderr)
@@ -0,0 +1,35 @@
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# A job thread that outlives the main thread, like an in-flight job during a container
+# restart: it only starts working once interpreter shutdown has begun
+JOB_AFTER_SHUTDOWN = """
+import asyncio
+import threading
+import time
+
+import main
+
+main.render_exists = lambda file_path: True
+
+def job():
+    time.sleep(0.5)
+    request = main.RenderRequest(script_code="class A(Scene): pass", scene_name="A")
+    print(asyncio.run(main.render_and_upload(request))["message"])
+    asyncio.run(main.acquire_render_slot())
+    print("Got a render slot")
+
+threading.Thread(target=job, daemon=False).start()
+"""
+
+
+def test_job_thread_keeps_working_after_shutdown_starts():
+    result = subprocess.run(
+        [sys.executable, "-c", JOB_AFTER_SHUTDOWN], cwd=REPO_DIR, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Reused existing render" in result.stdout
+    assert "Got a render slot" in result.stdout
@@ -0,0 +1,98 @@
+import base64
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import main
+
+UPLOAD_URL = "https://example.supabase.co/storage/v1/upload/resumable/abc"
+
+
+class FakeTusServer:
+    """Minimal Supabase TUS endpoint; `faults` maps a request number to a canned response."""
+
+    def __init__(self, faults=None):
+        self.stored = bytearray()
+        self.requests = []
+        self.faults = faults or {}
+
+    def __call__(self, request):
+        self.requests.append(request.method)
+        fault = self.faults.pop(len(self.requests), None)
+        if fault is not None:
+            if fault.status_code >= 500:
+                # The server kept part of the chunk before failing
+                self.stored.extend(request.content[:3])
+            return fault
+        if request.method == "POST":
+            self.metadata = {
+                key: base64.b64decode(value).decode()
+                for key, value in (item.split(" ") for item in request.headers["upload-metadata"].split(","))
+            }
+            return httpx.Response(201, headers={"Location": UPLOAD_URL})
+        if request.method == "HEAD":
+            return httpx.Response(200, headers={"Upload-Offset": str(len(self.stored))})
+        assert int(request.headers["upload-offset"]) == len(self.stored)
+        self.stored.extend(request.content)
+        return httpx.Response(204, headers={"Upload-Offset": str(len(self.stored))})
+
+
+@pytest.fixture
+def upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "TUS_CHUNK_SIZE", 8)
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    data = bytes(range(30))
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+
+    def run(server):
+        session = httpx.Client(base_url=main.storage.session.base_url, transport=httpx.MockTransport(server))
+        monkeypatch.setattr(main.storage, "session", session)
+        return main.upload_resumable("videos", "out.mp4", path, "video/mp4")
+
+    run.data = data
+    return run
+
+
+def test_uploads_in_chunks(upload):
+    server = FakeTusServer()
+    assert upload(server) == UPLOAD_URL
+    assert bytes(server.stored) == upload.data
+    assert server.requests == ["POST", "PATCH", "PATCH", "PATCH", "PATCH"]
+    assert server.metadata == {"bucketName": "videos", "objectName": "out.mp4", "contentType": "video/mp4"}
+
+
+def test_resumes_from_server_offset_after_5xx(upload):
+    server = FakeTusServer({3: httpx.Response(502)})
+    upload(server)
+    assert bytes(server.stored) == upload.data
+    assert server.requests[:5] == ["POST", "PATCH", "PATCH", "HEAD", "PATCH"]
+
+
+def test_retries_failed_offset_check(upload):
+    server = FakeTusServer({2: httpx.Response(503), 3: httpx.Response(503)})
+    upload(server)
+    assert bytes(server.stored) == upload.data
+    assert server.requests[:5] == ["POST", "PATCH", "HEAD", "HEAD", "PATCH"]
+
+
+@pytest.mark.parametrize("status", [400, 403, 409, 413])
+def test_does_not_retry_client_errors(upload, status):
+    server = FakeTusServer({2: httpx.Response(status)})
+    with pytest.raises(httpx.HTTPStatusError):
+        upload(server)
+    assert server.requests == ["POST", "PATCH"]
+
+
+def test_gives_up_after_retries(upload):
+    server = FakeTusServer({n: httpx.Response(503) for n in range(2, 20)})
+    with pytest.raises(httpx.HTTPStatusError):
+        upload(server)
+    assert len(server.requests) == 2 + main.TUS_CHUNK_RETRIES
+
+
+def test_missing_offset_header_fails_clearly(upload):
+    server = FakeTusServer({2: httpx.Response(204)})
+    with pytest.raises(HTTPException, match="Upload-Offset"):
+        upload(server)